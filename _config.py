@@ -0,0 +1,71 @@
+"""
+客户端共享配置
+notify_client 和 command_listener 共用，.env 只加载一次，HTTP 会话按需创建
+"""
+
+import os
+from pathlib import Path
+from threading import Lock
+
+_LOADED = False
+
+
+def load_env_once():
+    """加载 .env 文件（同一进程内只加载一次）"""
+    global _LOADED
+    if _LOADED:
+        return
+    _LOADED = True
+
+    # 尝试加载 .env 文件
+    try:
+        from dotenv import load_dotenv
+        env_path = Path(__file__).parent / ".env"
+        if env_path.exists():
+            load_dotenv(env_path)
+    except ImportError:
+        pass
+
+
+load_env_once()
+
+# ========== 配置 ==========
+PORT = os.getenv("NOTIFY_PORT", "8000")
+NOTIFY_SERVER = os.getenv("NOTIFY_SERVER", f"http://localhost:{PORT}")
+API_KEY = os.getenv("NOTIFY_API_KEY", "")
+
+# ========== HTTP 会话 ==========
+_session = None
+_session_lock = Lock()
+
+
+def get_session():
+    """
+    获取共享的 requests.Session
+
+    首次调用时才 import requests 并创建会话，只用异步 HTTP 客户端的脚本无需加载 requests。
+    - 复用连接（keep-alive），避免每次请求都重新做 TCP/TLS 握手
+    - Session 可在多线程间共享，只要 pool_maxsize >= 并发线程数
+    - read=False: 读超时不重试，直接抛出 ReadTimeout，既避免重复发送通知，也让长轮询超时能被识别
+    """
+    global _session
+    if _session is not None:
+        return _session
+
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            session = requests.Session()
+            session.headers.update({"X-API-Key": API_KEY, "Connection": "keep-alive"})
+            adapter = HTTPAdapter(
+                pool_connections=4,
+                pool_maxsize=16,
+                max_retries=Retry(total=2, read=False, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+    return _session
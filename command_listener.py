@@ -3,24 +3,22 @@
 在脚本中 import 这个模块即可接收 TG 命令
 """
 
-import os
-from pathlib import Path
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 import requests
 import time
 from threading import Thread
 
-# 尝试加载 .env 文件
-try:
-    from dotenv import load_dotenv
-    env_path = Path(__file__).parent / ".env"
-    if env_path.exists():
-        load_dotenv(env_path)
-except ImportError:
-    pass
+from _config import NOTIFY_SERVER, get_session
 
 # ========== 配置 ==========
-PORT = os.getenv("NOTIFY_PORT", "8000")
-DEFAULT_SERVER = os.getenv("NOTIFY_SERVER", f"http://localhost:{PORT}")
+DEFAULT_SERVER = NOTIFY_SERVER
+
+# 未知命令日志的最小间隔（秒），同一个 action 在这段时间内只记一次
+UNKNOWN_LOG_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
 
 
 class CommandListener:
@@ -43,19 +41,34 @@ class CommandListener:
         cmd.start()  # 启动后台轮询
     """
     
-    def __init__(self, target: str, server: str = None, poll_interval: float = 5):
+    def __init__(
+        self,
+        target: str,
+        server: str = None,
+        poll_interval: float = 5,
+        long_poll_timeout: float = 25,
+        handler_workers: int = 4
+    ):
         """
         Args:
             target: 脚本标识，如 "gold"、"monitor" 等
             server: 服务器地址，默认从环境变量读取
-            poll_interval: 轮询间隔（秒）
+            poll_interval: 轮询间隔（秒），仅在服务端不支持长轮询时使用
+            long_poll_timeout: 长轮询等待时间（秒），服务端最多挂起这么久才返回空结果
+            handler_workers: 执行命令处理函数的线程数，设为 1 可保证命令按顺序执行
         """
         self.target = target
         self.server = server or DEFAULT_SERVER
         self.poll_interval = poll_interval
+        self.long_poll_timeout = long_poll_timeout
         self.last_id = 0
         self.handlers = {}
+        self._known = frozenset()
+        self._unknown_logged = {}
         self._running = False
+        self._backoff = 0
+        # 处理函数在线程池中执行，慢的 handler（如发送通知）不会拖慢下一次轮询
+        self._executor = ThreadPoolExecutor(max_workers=handler_workers, thread_name_prefix="cmd-handler")
     
     def on(self, action: str):
         """
@@ -65,7 +78,7 @@ class CommandListener:
             action: 命令动作名，如 "stop"、"status" 等
         """
         def decorator(func):
-            self.handlers[action] = func
+            self.register(action, func)
             return func
         return decorator
     
@@ -77,7 +90,23 @@ class CommandListener:
             action: 命令动作名
             handler: 处理函数，接收 args 列表
         """
-        self.handlers[action] = handler
+        # 注册时统一规范化，poll 时只需做一次同样的处理
+        self.handlers[action.strip().lower()] = handler
+        self._known = frozenset(self.handlers)
+    
+    def _log_unknown(self, action: str):
+        """记录未知命令（按 action 限频，避免刷屏阻塞轮询）"""
+        now = time.monotonic()
+        if now - self._unknown_logged.get(action, -UNKNOWN_LOG_INTERVAL) >= UNKNOWN_LOG_INTERVAL:
+            self._unknown_logged[action] = now
+            logger.debug(f"[CommandListener] Unknown action: {action}")
+    
+    def _log_exception(self, action: str, future: Future):
+        """打印处理函数抛出的异常"""
+        e = future.exception()
+        # SystemExit 等（如 handler 中调用 exit()）不算错误
+        if isinstance(e, Exception):
+            print(f"[CommandListener] Handler error for '{action}': {e}")
     
     def poll(self) -> int:
         """
@@ -87,29 +116,38 @@ class CommandListener:
             int: 处理的命令数量
         """
         try:
-            resp = requests.get(
+            resp = get_session().get(
                 f"{self.server}/commands",
-                params={"target": self.target, "after": self.last_id},
-                timeout=10
+                params={"target": self.target, "after": self.last_id, "wait": self.long_poll_timeout},
+                timeout=self.long_poll_timeout + 10
             )
+            self._backoff = 0
+            if resp.status_code != 200:
+                # 鉴权失败、参数错误等不能当作"没有命令"静默吞掉
+                print(f"[CommandListener] Server returned {resp.status_code}: {resp.text[:200]}")
+                return 0
             data = resp.json()
             commands = data.get("commands", [])
             
             for cmd in commands:
                 self.last_id = max(self.last_id, cmd["id"])
-                handler = self.handlers.get(cmd["action"])
-                if handler:
-                    try:
-                        handler(cmd["args"])
-                    except Exception as e:
-                        print(f"[CommandListener] Handler error for '{cmd['action']}': {e}")
-                else:
-                    print(f"[CommandListener] Unknown action: {cmd['action']}")
+                action = cmd["action"].strip().lower()
+                if action not in self._known:
+                    self._log_unknown(action)
+                    continue
+                future = self._executor.submit(self.handlers[action], cmd["args"])
+                future.add_done_callback(partial(self._log_exception, action))
             
             return len(commands)
             
+        except requests.exceptions.ReadTimeout:
+            # 长轮询超时，视为没有新命令
+            self._backoff = 0
+            return 0
         except requests.exceptions.ConnectionError:
             print(f"[CommandListener] Cannot connect to {self.server}")
+            # 连接失败时指数退避: 1s -> 2s -> 4s -> 5s
+            self._backoff = min(self._backoff * 2, 5) if self._backoff else 1
             return 0
         except Exception as e:
             print(f"[CommandListener] Error: {e}")
@@ -125,8 +163,16 @@ class CommandListener:
         def loop():
             print(f"[CommandListener] 已启动，target={self.target}, server={self.server}")
             while self._running:
-                self.poll()
-                time.sleep(self.poll_interval)
+                started = time.monotonic()
+                count = self.poll()
+                if self._backoff:
+                    time.sleep(self._backoff)
+                elif count == 0:
+                    # 长轮询下空结果要等满 long_poll_timeout 才返回；
+                    # 如果立刻返回，说明服务端不支持长轮询，退回按 poll_interval 轮询
+                    remaining = self.poll_interval - (time.monotonic() - started)
+                    if remaining > 0:
+                        time.sleep(remaining)
         
         Thread(target=loop, daemon=True).start()
     
@@ -137,13 +183,18 @@ class CommandListener:
 
 # ========== 便捷函数 ==========
 
-def create_listener(target: str, server: str = None, poll_interval: float = 5) -> CommandListener:
+def create_listener(
+    target: str,
+    server: str = None,
+    poll_interval: float = 5,
+    long_poll_timeout: float = 25
+) -> CommandListener:
     """
     创建并返回一个 CommandListener 实例
     
-    这是 CommandListener(target, server, poll_interval) 的快捷方式
+    这是 CommandListener(target, server, poll_interval, long_poll_timeout) 的快捷方式
     """
-    return CommandListener(target, server, poll_interval)
+    return CommandListener(target, server, poll_interval, long_poll_timeout)
 
 
 # ========== 测试 ==========
@@ -12,15 +12,23 @@
 import asyncio
 import json
 import time
-from collections import deque
-from dataclasses import dataclass
+from itertools import islice
 from datetime import datetime
 from typing import Optional
 
 import aiohttp
+import numpy as np
 import websockets
 
-from notify_client import notify
+from notify_client import notify, NOTIFY_SERVER, API_KEY
+
+# orjson 解析更快，未安装时退回标准库
+# orjson.JSONDecodeError 是 json.JSONDecodeError 的子类，异常处理无需区分
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # ========== 告警配置（可自定义） ==========
 ALERT_RULES = [
@@ -36,25 +44,34 @@ ALERT_RULES = [
     # {"window_minutes": 30, "threshold": 80, "priority": "high", "name": "30分钟涨幅80%+"},
 ]
 
+# 按阈值从高到低排序，避免同一币种同时间窗口重复告警
+_SORTED_RULES = sorted(ALERT_RULES, key=lambda r: -r["threshold"])
+# 告警内容中展示的时间窗口
+_INFO_WINDOWS = (5, 15, 30, 60)
+# 每个 tick 需要计算涨跌幅的全部时间窗口
+_UNIQUE_WINDOWS = sorted({r["window_minutes"] for r in ALERT_RULES} | set(_INFO_WINDOWS))
+
 # ========== 系统配置 ==========
 SAMPLE_INTERVAL = 60  # 价格采样间隔（秒），建议 60 秒
 MAX_HISTORY_MINUTES = 60  # 最大保存历史（分钟），应大于等于最大时间窗口
 ALERT_COOLDOWN = 900  # 同规则同币种告警冷却时间（秒）
+INITIAL_SYMBOL_CAPACITY = 1024  # 价格矩阵初始行数，币种超出时自动翻倍
+MESSAGE_QUEUE_SIZE = 256  # WebSocket 待处理消息队列长度，满时丢弃最旧的一条
 
 # Binance WebSocket
 WS_URL = "wss://fstream.binance.com/ws/!miniTicker@arr"
 
-# ========== 数据结构 ==========
-@dataclass
-class PricePoint:
-    timestamp: float
-    price: float
-
-
 class PriceSurgeMonitor:
     def __init__(self):
-        # 价格历史: {symbol: deque of PricePoint}
-        self.price_history: dict[str, deque] = {}
+        # 价格历史: (币种, 分钟) 环形缓冲矩阵，每列是一次采样，未采样处为 NaN
+        self._prices = np.full((INITIAL_SYMBOL_CAPACITY, MAX_HISTORY_MINUTES), np.nan, dtype=np.float32)
+        # 下一次采样写入的列
+        self._head = 0
+        # 已采样的列数（最多 MAX_HISTORY_MINUTES）
+        self._filled = 0
+        # 币种 -> 行号，以及按行号排列的币种列表
+        self._sym_row: dict[str, int] = {}
+        self._symbols: list[str] = []
         # 最新价格: {symbol: price}
         self.latest_prices: dict[str, float] = {}
         # 告警冷却: {(symbol, rule_name): last_alert_time}
@@ -63,54 +80,60 @@ class PriceSurgeMonitor:
         self.last_sample_time = 0
         # 运行状态
         self.running = False
+        # 告警推送用的 HTTP 会话（run() 中创建）
+        self._http: Optional[aiohttp.ClientSession] = None
+        # WebSocket 收到的原始消息，接收和解析分开，解析慢时不会拖住接收
+        self._msg_q: asyncio.Queue = asyncio.Queue(maxsize=MESSAGE_QUEUE_SIZE)
         
-    def _get_or_create_history(self, symbol: str) -> deque:
-        """获取或创建币种的价格历史队列"""
-        if symbol not in self.price_history:
-            self.price_history[symbol] = deque(maxlen=MAX_HISTORY_MINUTES)
-        return self.price_history[symbol]
+    def _register_new_symbols(self):
+        """为新出现的币种分配行号，必要时扩容价格矩阵"""
+        # latest_prices 只增不删，新币种一定排在字典末尾，行号与字典顺序保持一致
+        # 单事件循环内与 _handle_message 不会交错执行，直接迭代无需先拷贝成 list
+        for symbol in islice(self.latest_prices, len(self._symbols), None):
+            self._sym_row[symbol] = len(self._symbols)
+            self._symbols.append(symbol)
+        
+        capacity = self._prices.shape[0]
+        if len(self._symbols) > capacity:
+            while capacity < len(self._symbols):
+                capacity *= 2
+            grown = np.full((capacity, MAX_HISTORY_MINUTES), np.nan, dtype=np.float32)
+            grown[:self._prices.shape[0]] = self._prices
+            self._prices = grown
+    
+    def _current_prices(self) -> np.ndarray:
+        """按行号顺序返回已登记币种的最新价格"""
+        return np.fromiter(self.latest_prices.values(), dtype=np.float32, count=len(self._symbols))
     
     def _sample_prices(self):
         """采样当前所有币种的价格到历史记录"""
         now = time.time()
-        point_time = now
         
-        sampled_count = 0
-        for symbol, price in self.latest_prices.items():
-            history = self._get_or_create_history(symbol)
-            history.append(PricePoint(timestamp=point_time, price=price))
-            sampled_count += 1
+        if len(self.latest_prices) > len(self._symbols):
+            self._register_new_symbols()
+        
+        sampled_count = len(self._symbols)
+        self._prices[:sampled_count, self._head] = self._current_prices()
+        self._head = (self._head + 1) % MAX_HISTORY_MINUTES
+        self._filled = min(self._filled + 1, MAX_HISTORY_MINUTES)
         
         self.last_sample_time = now
         return sampled_count
     
-    def _calculate_change(self, symbol: str, window_minutes: int) -> Optional[float]:
-        """计算指定时间窗口内的涨跌幅"""
-        if symbol not in self.price_history:
-            return None
-        
-        history = self.price_history[symbol]
-        if len(history) < window_minutes:
-            return None
-        
-        current_price = self.latest_prices.get(symbol)
-        if not current_price:
-            return None
-        
-        # 获取 window_minutes 分钟前的价格
-        old_point = history[-window_minutes]
-        old_price = old_point.price
-        
-        if old_price <= 0:
-            return None
-        
-        change_pct = (current_price - old_price) / old_price * 100
-        return change_pct
+    def _window_changes(self, window_minutes: int, current: Optional[np.ndarray] = None) -> np.ndarray:
+        """计算所有币种在指定时间窗口内的涨跌幅，无法计算的位置为 NaN"""
+        if current is None:
+            current = self._current_prices()
+        old = self._prices[:len(self._symbols), (self._head - window_minutes) % MAX_HISTORY_MINUTES]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            changes = (current - old) / old * 100
+        # 历史不足（NaN）或价格异常（<=0）
+        changes[~(old > 0)] = np.nan
+        return changes
     
-    def _can_alert(self, symbol: str, rule_name: str) -> bool:
-        """检查是否可以发送告警（防止刷屏）"""
+    def _can_alert(self, symbol: str, rule_name: str, now: float) -> bool:
+        """检查是否可以发送告警（防止刷屏），now 由调用方每个 tick 取一次"""
         key = (symbol, rule_name)
-        now = time.time()
         last_time = self.alert_cooldowns.get(key, 0)
         
         if now - last_time >= ALERT_COOLDOWN:
@@ -118,41 +141,66 @@ class PriceSurgeMonitor:
             return True
         return False
     
-    def _check_alerts(self):
+    async def _notify_async(self, title: str, message: str, channel: str, priority: str) -> bool:
+        """异步发送通知，不阻塞事件循环（WebSocket 读取不会因此停顿）"""
+        try:
+            async with self._http.post(
+                f"{NOTIFY_SERVER}/notify",
+                json={
+                    "channel": channel,
+                    "title": title,
+                    "message": message,
+                    "priority": priority
+                },
+                timeout=aiohttp.ClientTimeout(total=10)
+            ) as resp:
+                return resp.status == 200
+        except Exception as e:
+            print(f"[Notify Error] {e}")
+            return False
+    
+    async def _check_alerts(self):
         """检查所有规则，触发告警"""
-        now_str = datetime.now().strftime("%H:%M:%S")
-        alerts_sent = 0
-        
-        # 按阈值从高到低排序，避免同一币种同时间窗口重复告警
-        sorted_rules = sorted(ALERT_RULES, key=lambda r: -r["threshold"])
+        # 整个 tick 共用同一个时间点
+        now = time.time()
+        now_str = time.strftime("%H:%M:%S", time.localtime(now))
+        # 待发送的告警: [(symbol, coroutine)]，最后并发发送
+        pending = []
         
-        # 记录已告警的 (symbol, window) 组合
-        alerted = set()
+        # 每个时间窗口的涨跌幅整个 tick 只算一次，规则匹配和告警内容共用
+        # 历史不足的窗口不出现在字典里
+        n = len(self._symbols)
+        current = self._current_prices()
+        changes_by_window = {
+            w: self._window_changes(w, current)
+            for w in _UNIQUE_WINDOWS
+            if self._filled >= w
+        }
+        # 记录已告警的 (symbol, window) 组合: {window: 按行号的布尔掩码}
+        alerted = {w: np.zeros(n, dtype=bool) for w in changes_by_window}
         
-        for symbol in list(self.latest_prices.keys()):
-            for rule in sorted_rules:
-                window = rule["window_minutes"]
-                threshold = rule["threshold"]
-                priority = rule["priority"]
-                rule_name = rule["name"]
-                
-                # 跳过已处理的更高阈值
-                if (symbol, window) in alerted:
-                    continue
-                
-                change = self._calculate_change(symbol, window)
-                if change is None:
-                    continue
-                
-                # 只关注涨幅（正数）
-                if change < threshold:
-                    continue
-                
-                # 标记已处理
-                alerted.add((symbol, window))
+        for rule in _SORTED_RULES:
+            window = rule["window_minutes"]
+            threshold = rule["threshold"]
+            priority = rule["priority"]
+            rule_name = rule["name"]
+            
+            changes = changes_by_window.get(window)
+            if changes is None:
+                continue
+            
+            # 只关注涨幅（正数），跳过已处理的更高阈值；NaN 比较结果为 False，自动排除
+            hits = np.flatnonzero((changes >= threshold) & ~alerted[window])
+            
+            # 标记已处理
+            alerted[window][hits] = True
+            
+            for row in hits:
+                symbol = self._symbols[row]
+                change = float(changes[row])
                 
                 # 检查冷却
-                if not self._can_alert(symbol, rule_name):
+                if not self._can_alert(symbol, rule_name, now):
                     continue
                 
                 # 发送告警
@@ -172,77 +220,97 @@ class PriceSurgeMonitor:
                 
                 # 收集其他时间窗口的涨幅
                 changes_info = []
-                for w in [5, 15, 30, 60]:
-                    c = self._calculate_change(symbol, w)
-                    if c is not None:
+                for w in _INFO_WINDOWS:
+                    w_changes = changes_by_window.get(w)
+                    if w_changes is None:
+                        continue
+                    c = w_changes[row]
+                    if not np.isnan(c):
                         marker = " ⬅️" if w == window else ""
                         changes_info.append(f"  • {w}分钟: {c:+.2f}%{marker}")
                 
-                message = (
-                    f"当前价格: ${current_price:.6g}\n"
-                    f"\n"
-                    f"📊 涨幅情况:\n"
-                    f"{chr(10).join(changes_info)}\n"
-                    f"\n"
-                    f"📋 触发规则: {rule_name}\n"
-                    f"⏰ 检测时间: {now_str}"
-                )
+                message = "\n".join([
+                    f"当前价格: ${current_price:.6g}",
+                    "",
+                    "📊 涨幅情况:",
+                    *changes_info,
+                    "",
+                    f"📋 触发规则: {rule_name}",
+                    f"⏰ 检测时间: {now_str}",
+                ])
                 
                 print(f"[ALERT] {symbol}: {change:.2f}% ({rule_name}), priority={priority}")
                 
-                success = notify(
+                pending.append((symbol, self._notify_async(
                     title=title,
                     message=message,
                     channel="price",
                     priority=priority
-                )
-                
-                if success:
-                    alerts_sent += 1
-                    print(f"[OK] 通知已发送: {symbol}")
-                else:
-                    print(f"[FAIL] 通知发送失败: {symbol}")
+                )))
+        
+        if not pending:
+            return 0
+        
+        # 并发发送，一批告警只需一个 RTT
+        results = await asyncio.gather(*(coro for _, coro in pending))
+        alerts_sent = 0
+        for (symbol, _), success in zip(pending, results):
+            if success:
+                alerts_sent += 1
+                print(f"[OK] 通知已发送: {symbol}")
+            else:
+                print(f"[FAIL] 通知发送失败: {symbol}")
         
         return alerts_sent
     
-    async def _handle_message(self, data: list):
-        """处理 WebSocket 消息"""
+    def _handle_message(self, data: list):
+        """处理 WebSocket 消息（纯同步，不经过事件循环调度）"""
         for ticker in data:
-            symbol = ticker.get("s", "")
-            if not symbol.endswith("USDT"):
+            try:
+                symbol = ticker["s"]
+                # 先过滤非 USDT 交易对，再做 float 转换
+                if not symbol.endswith("USDT"):
+                    continue
+                price = float(ticker["c"])
+            except (KeyError, TypeError, ValueError):
+                # 字段缺失、ticker 不是对象、价格无法解析
                 continue
             
-            price = float(ticker.get("c", 0))
             if price > 0:
                 self.latest_prices[symbol] = price
     
     def _get_top_gainers(self, window_minutes: int, top_n: int = 3) -> list[tuple[str, float]]:
         """获取涨幅最高的币种"""
-        gainers = []
-        for symbol in self.latest_prices.keys():
-            change = self._calculate_change(symbol, window_minutes)
-            if change is not None:
-                gainers.append((symbol, change))
+        if self._filled < window_minutes:
+            return []
+        
+        changes = self._window_changes(window_minutes)
+        valid = np.flatnonzero(~np.isnan(changes))
         
-        # 按涨幅排序
-        gainers.sort(key=lambda x: x[1], reverse=True)
-        return gainers[:top_n]
+        # argpartition 选出前 top_n（O(N)），只对这 top_n 个排序
+        top = valid
+        if top_n < len(valid):
+            top = valid[np.argpartition(-changes[valid], top_n)[:top_n]]
+        top = top[np.argsort(-changes[top])]
+        return [(self._symbols[i], float(changes[i])) for i in top]
     
     async def _sample_loop(self):
         """定时采样循环"""
+        # 按绝对时间（monotonic）对齐采样点，_check_alerts 的耗时不会累积成漂移，
+        # 保证 "N 个采样前" 始终对应 N 分钟前
+        next_tick = time.monotonic() + SAMPLE_INTERVAL
         while self.running:
-            await asyncio.sleep(SAMPLE_INTERVAL)
+            await asyncio.sleep(max(0, next_tick - time.monotonic()))
+            next_tick += SAMPLE_INTERVAL
             
             now_str = datetime.now().strftime("%H:%M:%S")
             sampled = self._sample_prices()
             
             # 检查告警
-            alerts = self._check_alerts()
+            alerts = await self._check_alerts()
             
             # 状态输出
-            history_len = 0
-            if self.price_history:
-                history_len = len(next(iter(self.price_history.values())))
+            history_len = self._filled
             
             print(f"\n[{now_str}] ━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━")
             print(f"  📊 采样: {sampled} 个币种 | 历史: {history_len}/{MAX_HISTORY_MINUTES} 分钟")
@@ -277,11 +345,10 @@ class PriceSurgeMonitor:
                         if not self.running:
                             break
                         
-                        try:
-                            data = json.loads(message)
-                            await self._handle_message(data)
-                        except json.JSONDecodeError:
-                            pass
+                        # 处理跟不上时丢弃最旧的消息，保证接收不阻塞、连接不被断开
+                        if self._msg_q.full():
+                            self._msg_q.get_nowait()
+                        self._msg_q.put_nowait(message)
                         
             except Exception as e:
                 print(f"[WS] 连接断开: {e}")
@@ -289,6 +356,25 @@ class PriceSurgeMonitor:
                     print(f"[WS] 5秒后重连...")
                     await asyncio.sleep(5)
     
+    async def _consume_loop(self):
+        """消息处理循环：从队列取出 WebSocket 消息，解析并更新最新价格"""
+        while self.running:
+            message = await self._msg_q.get()
+            try:
+                data = json_loads(message)
+            except json.JSONDecodeError:
+                continue
+            
+            # 只处理 ticker 数组，错误/回执等对象帧直接忽略
+            if not isinstance(data, list):
+                continue
+            
+            # 单帧处理失败不能让整个任务退出（gather 会连带停掉监控）
+            try:
+                self._handle_message(data)
+            except Exception as e:
+                print(f"[WS] 消息处理失败: {e}")
+    
     async def run(self):
         """启动监控"""
         print("=" * 60)
@@ -318,11 +404,16 @@ class PriceSurgeMonitor:
         )
         
         self.running = True
+        self._http = aiohttp.ClientSession(
+            headers={"X-API-Key": API_KEY},
+            connector=aiohttp.TCPConnector(limit=8, keepalive_timeout=60)
+        )
         
         try:
-            # 并行运行 WebSocket 和采样循环
+            # 并行运行 WebSocket 接收、消息处理和采样循环
             await asyncio.gather(
                 self._websocket_loop(),
+                self._consume_loop(),
                 self._sample_loop()
             )
         except KeyboardInterrupt:
@@ -336,6 +427,7 @@ class PriceSurgeMonitor:
                 channel="price",
                 priority="normal"
             )
+            await self._http.close()
 
 
 def main():
@@ -3,23 +3,19 @@
 在任何监控脚本中 import 这个模块即可发送通知
 """
 
-import os
-from pathlib import Path
-import requests
+import json
 
-# 尝试加载 .env 文件
+from _config import PORT, NOTIFY_SERVER, API_KEY, get_session
+
+# 请求体自行编码为 bytes，跳过 requests 内部的 json.dumps；orjson 未安装时退回标准库
 try:
-    from dotenv import load_dotenv
-    env_path = Path(__file__).parent / ".env"
-    if env_path.exists():
-        load_dotenv(env_path)
+    from orjson import dumps as _dumps
 except ImportError:
-    pass
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
 
-# ========== 配置 ==========
-PORT = os.getenv("NOTIFY_PORT", "8000")
-NOTIFY_SERVER = os.getenv("NOTIFY_SERVER", f"http://localhost:{PORT}")
-API_KEY = os.getenv("NOTIFY_API_KEY", "")
+# X-API-Key / keep-alive 已是会话默认头，这里只需补上 Content-Type
+_JSON_HEADERS = {"Content-Type": "application/json"}
 
 
 def notify(
@@ -44,15 +40,16 @@ def notify(
         bool: 是否发送成功
     """
     try:
-        resp = requests.post(
+        body = _dumps({
+            "channel": channel,
+            "title": title,
+            "message": message,
+            "priority": priority
+        })
+        resp = get_session().post(
             f"{NOTIFY_SERVER}/notify",
-            json={
-                "channel": channel,
-                "title": title,
-                "message": message,
-                "priority": priority
-            },
-            headers={"X-API-Key": API_KEY},
+            data=body,
+            headers=_JSON_HEADERS,
             timeout=10
         )
         return resp.status_code == 200
@@ -81,10 +78,9 @@ def call_now(message: str = "紧急告警，请查看") -> bool:
         bool: 是否成功
     """
     try:
-        resp = requests.post(
+        resp = get_session().post(
             f"{NOTIFY_SERVER}/call",
             params={"message": message},
-            headers={"X-API-Key": API_KEY},
             timeout=30
         )
         return resp.status_code == 200
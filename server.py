@@ -5,18 +5,24 @@ Telegram 通知机器人服务端 v2.1
 
 import os
 import asyncio
+import bisect
+import heapq
+import secrets
 import time
 from collections import defaultdict
-from datetime import datetime
+from html import escape
+from operator import itemgetter
 from pathlib import Path
+import httpx
+import orjson
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Header, Request, Query
+from fastapi import Depends, FastAPI, HTTPException, Header, Request, Query
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters
-from twilio.rest import Client as TwilioClient
+from telegram.ext import Application, CallbackQueryHandler, MessageHandler, filters
+from telegram.request import HTTPXRequest
 import uvicorn
-import threading
 import logging
 
 # 加载 .env 文件
@@ -38,6 +44,13 @@ PHONE_TO = os.getenv("PHONE_TO")  # 你的手机号（香港号码）
 # 告警配置
 CALL_DELAY_SECONDS = int(os.getenv("CALL_DELAY_SECONDS", 300))  # 默认 5 分钟
 
+# Telegram 发送限速（单个 bot 上限约 30 条/秒）
+SEND_RATE = 25  # 令牌桶每秒补充的令牌数
+SEND_BURST = 5  # 令牌桶容量（允许的突发条数）
+SEND_COALESCE_WINDOW = 0.05  # 合并窗口（秒），窗口内同一来源的消息合并为一条
+SEND_CONCURRENCY = 32  # 同时在途的 send_message 请求上限
+TG_MAX_MESSAGE_LENGTH = 4096
+
 # TradingView Webhook Secret
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "tv_" + os.urandom(8).hex())
 
@@ -57,26 +70,73 @@ CHANNEL_EMOJI = {
 }
 
 # 存储待确认的 critical 告警
-# {alert_id: {"message": str, "time": float, "confirmed": bool, "call_task": Task}}
+# {alert_id: {"message": str, "time": float, "confirmed": bool}}
 pending_alerts = {}
 
-# ========== 命令系统 ==========
-# 命令存储: {target: [cmd1, cmd2, ...]}
-commands_store = defaultdict(list)
-command_id_counter = 0
-commands_lock = threading.Lock()
+# 电话告警定时器: 最小堆 [(deadline, alert_id)]，由 alert_scheduler 统一处理
+# deadline 使用 time.monotonic()（与事件循环时钟一致），不受系统时间调整影响
+# 所有告警共用一个后台任务，而不是每条告警一个 sleep 中的 Task
+_alert_heap: list[tuple[float, str]] = []
+_alert_wakeup = asyncio.Event()
+# 到期告警的处理任务（发通知 + 打电话）各自独立运行，持有引用防止被 GC 回收
+_call_tasks: set[asyncio.Task] = set()
 
-app = FastAPI(title="TG Notify Server v2.1")
-bot = Bot(token=BOT_TOKEN)
-twilio_client = None
+# Telegram 发送队列: [(合并键, text, reply_markup, future)]，由 send_worker 统一限速发送
+_send_q: asyncio.Queue = asyncio.Queue()
+# 在途的发送任务: 限速只控制发起速率，请求本身并发进行，一条卡住的请求不会阻塞后面的消息
+_send_slots = asyncio.Semaphore(SEND_CONCURRENCY)
+_send_tasks: set[asyncio.Task] = set()
 
-if TWILIO_SID and TWILIO_TOKEN:
-    twilio_client = TwilioClient(TWILIO_SID, TWILIO_TOKEN)
+# ========== 命令系统 ==========
+# 命令存储: {target: (ids, cmds)}，ids 与 cmds 一一对应
+# 命令 id 单调递增、按顺序追加，ids 天然有序，拉取时二分查找起点
+# 约定: commands_store / command_id_counter 只在 FastAPI 事件循环中访问，
+# 协作式调度下读写不会交错，因此无需加锁
+commands_store: dict[str, tuple[list[int], list[dict]]] = defaultdict(lambda: ([], []))
+command_id_counter = 0
+# 有新命令时唤醒长轮询中的 /commands 请求
+_cmd_cv = asyncio.Condition()
+# 长轮询最长等待时间（秒）
+MAX_COMMAND_WAIT = 60
+
+# 响应统一用 orjson 序列化（/commands 长轮询返回的命令列表最受益）
+app = FastAPI(title="TG Notify Server v2.1", default_response_class=ORJSONResponse)
+# 所有 HTTP 接口共用一个 Bot，到 api.telegram.org 的连接池化复用（HTTP/2 多路复用）
+# 注意: httpx 连接池绑定事件循环，这个 bot 只能在 FastAPI 的事件循环中使用
+bot = Bot(
+    token=BOT_TOKEN,
+    request=HTTPXRequest(connection_pool_size=256, http_version="2.0")
+)
+
+# Twilio REST API 走进程共享的 app.state.http 异步调用，拨号不阻塞事件循环
+TWILIO_CONFIGURED = bool(TWILIO_SID and TWILIO_TOKEN)
+TWILIO_AUTH = httpx.BasicAuth(TWILIO_SID or "", TWILIO_TOKEN or "")
+TWILIO_CALLS_URL = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_SID}/Calls.json"
+
+if TWILIO_CONFIGURED:
     logger.info("✓ Twilio 已配置")
 else:
     logger.warning("⚠ Twilio 未配置，critical 告警将不会打电话")
 
 
+@app.on_event("startup")
+async def _open_http_client():
+    """
+    创建进程共享的异步 HTTP 客户端（Twilio 及后续外部集成共用）
+    
+    - HTTP/2: 到同一主机的请求复用一条 TCP+TLS 连接
+    - trust_env=False: 不读代理等环境变量，省去每次请求的环境查找
+    - 认证按请求传入，不同集成可共用同一个连接池
+    注意: PTB 的 HTTPXRequest 不接受外部传入的客户端，bot 仍用自己的连接池
+    """
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        trust_env=False,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+        timeout=10
+    )
+
+
 class NotifyRequest(BaseModel):
     channel: str = "info"
     title: str
@@ -84,81 +144,247 @@ class NotifyRequest(BaseModel):
     priority: str = "normal"  # normal / high / critical
 
 
+def build_message(priority_mark: str, emoji: str, title: str, message: str, channel: str, suffix: str = "") -> str:
+    """
+    拼装 TG 消息（HTML），/notify 与 TradingView webhook 共用
+    
+    title / message / channel 来自调用方，先做 HTML 转义，避免 Telegram 因解析失败拒收；
+    <b> / <code> 等标签由这里统一添加
+    """
+    timestamp = time.strftime("%H:%M:%S")
+    return "".join((
+        priority_mark, emoji, " <b>", escape(title, quote=False), "</b>\n\n",
+        escape(message, quote=False),
+        "\n\n<code>[", escape(channel, quote=False), "] ", timestamp, "</code>",
+        suffix
+    ))
+
+
 def format_message(req: NotifyRequest, alert_id: str = None) -> str:
     """格式化消息"""
     emoji = CHANNEL_EMOJI.get(req.channel, "📢")
-    timestamp = datetime.now().strftime("%H:%M:%S")
     
     priority_mark = ""
+    suffix = ""
     if req.priority == "high":
         priority_mark = "🔴 "
     elif req.priority == "critical":
         priority_mark = "🚨🚨🚨 CRITICAL 🚨🚨🚨\n"
+        suffix = f"\n\n⏰ <b>{CALL_DELAY_SECONDS // 60} 分钟内未确认将自动拨打电话</b>"
     
-    text = f"""{priority_mark}{emoji} <b>{req.title}</b>
+    return build_message(priority_mark, emoji, req.title, req.message, req.channel, suffix)
 
-{req.message}
 
-<code>[{req.channel}] {timestamp}</code>"""
+async def enqueue_send(text: str, key: tuple = None, reply_markup: InlineKeyboardMarkup = None):
+    """
+    放入发送队列，等待实际发送完成
     
-    if req.priority == "critical":
-        delay_min = CALL_DELAY_SECONDS // 60
-        text += f"\n\n⏰ <b>{delay_min} 分钟内未确认将自动拨打电话</b>"
+    Args:
+        text: 消息内容（HTML）
+        key: 合并键，如 (channel, title)；合并窗口内键相同的消息合并为一条，None 表示不合并
+        reply_markup: 按钮；带按钮的消息从不合并
     
-    return text
+    Returns:
+        Telegram 返回的 Message，发送失败时抛出异常
+    """
+    future = asyncio.get_running_loop().create_future()
+    _send_q.put_nowait((key, text, reply_markup, future))
+    return await future
+
+
+def _coalesce(batch: list) -> list:
+    """把一批待发送消息按合并键分组，返回 [(text, reply_markup, futures)]"""
+    groups = []
+    open_groups = {}
+    # 预留 "(xN)" 后缀的长度
+    limit = TG_MAX_MESSAGE_LENGTH - 16
+    
+    for key, text, reply_markup, future in batch:
+        mergeable = key is not None and reply_markup is None
+        group = open_groups.get(key) if mergeable else None
+        if group is not None and group["length"] + 2 + len(text) <= limit:
+            group["texts"].append(text)
+            group["futures"].append(future)
+            group["length"] += 2 + len(text)
+            continue
+        
+        group = {"texts": [text], "reply_markup": reply_markup, "futures": [future], "length": len(text)}
+        groups.append(group)
+        if mergeable:
+            open_groups[key] = group
+    
+    result = []
+    for group in groups:
+        texts = group["texts"]
+        text = texts[0] if len(texts) == 1 else "\n\n".join(texts) + f"\n\n(x{len(texts)})"
+        result.append((text, group["reply_markup"], group["futures"]))
+    return result
+
+
+async def send_worker():
+    """发送队列消费者: 合并短时间内的重复消息，按令牌桶限速调用 Telegram"""
+    loop = asyncio.get_running_loop()
+    tokens = SEND_BURST
+    last = loop.time()
+    
+    while True:
+        batch = [await _send_q.get()]
+        # 等待一个合并窗口，收集同一波突发的消息
+        await asyncio.sleep(SEND_COALESCE_WINDOW)
+        while not _send_q.empty():
+            batch.append(_send_q.get_nowait())
+        
+        for text, reply_markup, futures in _coalesce(batch):
+            now = loop.time()
+            tokens = min(SEND_BURST, tokens + (now - last) * SEND_RATE)
+            last = now
+            if tokens < 1:
+                await asyncio.sleep((1 - tokens) / SEND_RATE)
+                tokens = 1
+                last = loop.time()
+            tokens -= 1
+            
+            await _send_slots.acquire()
+            task = asyncio.create_task(_send_group(text, reply_markup, futures))
+            _send_tasks.add(task)
+            task.add_done_callback(_send_tasks.discard)
 
 
-def make_phone_call(message: str) -> bool:
+async def _send_group(text: str, reply_markup: InlineKeyboardMarkup, futures: list):
+    """发送一条（可能已合并的）消息，并把结果交给所有等待者"""
+    try:
+        msg = await bot.send_message(
+            chat_id=CHAT_ID,
+            text=text,
+            parse_mode="HTML",
+            reply_markup=reply_markup
+        )
+    except Exception as e:
+        for future in futures:
+            if not future.done():
+                future.set_exception(e)
+    else:
+        for future in futures:
+            if not future.done():
+                future.set_result(msg)
+    finally:
+        _send_slots.release()
+
+
+@app.on_event("startup")
+async def _start_send_worker():
+    """启动 Telegram 发送队列"""
+    app.state.send_worker = asyncio.create_task(send_worker())
+
+
+# TwiML: 语音播报两遍
+TWIML_TEMPLATE = (
+    '<Response>'
+    '<Say language="zh-CN">注意，紧急告警：{message}</Say>'
+    '<Pause length="2"/>'
+    '<Say language="zh-CN">重复一遍：{message}</Say>'
+    '<Pause length="1"/>'
+    '<Say language="zh-CN">请立即处理</Say>'
+    '</Response>'
+)
+
+
+def ack_markup(alert_id: str) -> InlineKeyboardMarkup:
+    """critical 告警的确认按钮"""
+    return InlineKeyboardMarkup.from_button(
+        InlineKeyboardButton("✅ 已收到，取消电话", callback_data=f"ack_{alert_id}")
+    )
+
+
+async def make_phone_call(message: str) -> bool:
     """拨打电话"""
-    if not twilio_client or not TWILIO_FROM or not PHONE_TO:
+    if not TWILIO_CONFIGURED or not TWILIO_FROM or not PHONE_TO:
         logger.error("Twilio 未正确配置，无法拨打电话")
         return False
     
     try:
-        # TwiML: 语音播报两遍
-        twiml = f'''<Response>
-            <Say language="zh-CN">注意，紧急告警：{message}</Say>
-            <Pause length="2"/>
-            <Say language="zh-CN">重复一遍：{message}</Say>
-            <Pause length="1"/>
-            <Say language="zh-CN">请立即处理</Say>
-        </Response>'''
-        
-        call = twilio_client.calls.create(
-            to=PHONE_TO,
-            from_=TWILIO_FROM,
-            twiml=twiml
+        resp = await app.state.http.post(
+            TWILIO_CALLS_URL,
+            auth=TWILIO_AUTH,
+            # message 来自调用方，嵌入 TwiML (XML) 前先转义，避免 "<"、"&" 等字符导致拨号失败
+            data={"To": PHONE_TO, "From": TWILIO_FROM, "Twiml": TWIML_TEMPLATE.format(message=escape(message))}
         )
-        logger.info(f"📞 电话已拨出: {call.sid}")
+        resp.raise_for_status()
+        logger.info(f"📞 电话已拨出: {resp.json()['sid']}")
         return True
     except Exception as e:
         logger.error(f"拨打电话失败: {e}")
         return False
 
 
-async def delayed_call_check(alert_id: str, message: str):
-    """延迟检查是否需要打电话"""
-    await asyncio.sleep(CALL_DELAY_SECONDS)
-    
+def schedule_call_check(alert_id: str):
+    """登记 critical 告警，CALL_DELAY_SECONDS 后仍未确认则打电话"""
+    heapq.heappush(_alert_heap, (time.monotonic() + CALL_DELAY_SECONDS, alert_id))
+    _alert_wakeup.set()
+
+
+async def call_if_unconfirmed(alert_id: str):
+    """到期检查告警是否已确认，未确认则打电话"""
     alert = pending_alerts.get(alert_id)
     if alert and not alert.get("confirmed"):
         logger.info(f"告警 {alert_id} 未确认，准备拨打电话...")
         
         # 发送即将打电话的通知
         try:
-            await bot.send_message(
-                chat_id=CHAT_ID,
-                text="📞 <b>即将拨打电话...</b>\n\n未在规定时间内确认告警",
-                parse_mode="HTML"
-            )
+            await enqueue_send("📞 <b>即将拨打电话...</b>\n\n未在规定时间内确认告警")
         except:
             pass
         
         # 打电话
-        make_phone_call(message)
+        await make_phone_call(alert["message"])
+    
+    # 清理
+    pending_alerts.pop(alert_id, None)
+
+
+async def _run_call_check(alert_id: str):
+    """执行一条到期告警的检查，异常只记录日志"""
+    try:
+        await call_if_unconfirmed(alert_id)
+    except Exception as e:
+        logger.error(f"电话告警处理失败: {e}")
+
+
+async def alert_scheduler():
+    """电话告警调度: 等待堆顶告警到期，期间有新告警登记时被唤醒重新计算"""
+    while True:
+        if not _alert_heap:
+            await _alert_wakeup.wait()
+            _alert_wakeup.clear()
+            continue
         
-        # 清理
-        pending_alerts.pop(alert_id, None)
+        deadline, alert_id = _alert_heap[0]
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(_alert_wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            _alert_wakeup.clear()
+            continue
+        
+        heapq.heappop(_alert_heap)
+        # 每条到期告警单独一个任务，慢的 Telegram / Twilio 请求不会拖住后面的电话
+        task = asyncio.create_task(_run_call_check(alert_id))
+        _call_tasks.add(task)
+        task.add_done_callback(_call_tasks.discard)
+
+
+@app.on_event("startup")
+async def _start_alert_scheduler():
+    """启动电话告警调度任务"""
+    app.state.alert_scheduler = asyncio.create_task(alert_scheduler())
+
+
+@app.on_event("shutdown")
+async def _close_http_client():
+    """关闭共享的异步 HTTP 客户端"""
+    await app.state.http.aclose()
 
 
 async def handle_callback(update: Update, context):
@@ -183,27 +409,28 @@ async def handle_callback(update: Update, context):
             await query.message.reply_text("⚠️ 该告警已过期或已处理")
 
 
+async def require_key(x_api_key: str = Header(None)):
+    """
+    API Key 校验（依赖项）
+    
+    依赖项先于请求体校验执行，无效 Key 不会走到 pydantic 解析；
+    使用 compare_digest 做恒定时间比较，避免计时侧信道
+    """
+    if not (API_KEY and x_api_key and secrets.compare_digest(x_api_key.encode(), API_KEY.encode())):
+        raise HTTPException(status_code=401, detail="Invalid API Key")
+
+
 @app.post("/notify")
-async def notify(req: NotifyRequest, x_api_key: str = Header(None)):
+async def notify(req: NotifyRequest, _: None = Depends(require_key)):
     """接收通知并转发到 Telegram"""
-    if x_api_key != API_KEY:
-        raise HTTPException(status_code=401, detail="Invalid API Key")
-    
-    alert_id = f"{int(time.time() * 1000)}"
+    # 纳秒级单调时钟，高并发下也不会重复
+    alert_id = str(time.monotonic_ns())
     text = format_message(req, alert_id)
     
     try:
         if req.priority == "critical":
             # Critical: 带确认按钮 + 延迟打电话
-            keyboard = [[InlineKeyboardButton("✅ 已收到，取消电话", callback_data=f"ack_{alert_id}")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            msg = await bot.send_message(
-                chat_id=CHAT_ID,
-                text=text,
-                parse_mode="HTML",
-                reply_markup=reply_markup
-            )
+            await enqueue_send(text, reply_markup=ack_markup(alert_id))
             
             # 记录待确认告警
             pending_alerts[alert_id] = {
@@ -212,19 +439,15 @@ async def notify(req: NotifyRequest, x_api_key: str = Header(None)):
                 "confirmed": False
             }
             
-            # 启动延迟检查任务
-            asyncio.create_task(delayed_call_check(alert_id, f"{req.title}: {req.message}"))
+            # 登记延迟检查
+            schedule_call_check(alert_id)
             
             logger.info(f"🚨 Critical 告警已发送: {alert_id}")
             return {"status": "ok", "alert_id": alert_id, "message": "Critical notification sent, phone call scheduled"}
         
         else:
-            # Normal/High: 普通发送
-            await bot.send_message(
-                chat_id=CHAT_ID,
-                text=text,
-                parse_mode="HTML"
-            )
+            # Normal/High: 普通发送，同来源的突发消息会被合并
+            await enqueue_send(text, key=(req.channel, req.title))
             return {"status": "ok", "message": "Notification sent"}
             
     except Exception as e:
@@ -233,12 +456,9 @@ async def notify(req: NotifyRequest, x_api_key: str = Header(None)):
 
 
 @app.post("/call")
-async def direct_call(x_api_key: str = Header(None), message: str = "紧急告警，请查看"):
+async def direct_call(message: str = "紧急告警，请查看", _: None = Depends(require_key)):
     """直接拨打电话（跳过 TG 确认）"""
-    if x_api_key != API_KEY:
-        raise HTTPException(status_code=401, detail="Invalid API Key")
-    
-    success = make_phone_call(message)
+    success = await make_phone_call(message)
     if success:
         return {"status": "ok", "message": "Phone call initiated"}
     else:
@@ -250,7 +470,7 @@ async def health():
     """健康检查"""
     return {
         "status": "healthy",
-        "twilio_configured": twilio_client is not None,
+        "twilio_configured": TWILIO_CONFIGURED,
         "pending_alerts": len(pending_alerts)
     }
 
@@ -259,20 +479,12 @@ async def health():
 async def test_notification():
     """测试接口（无需认证）- 仅用于快速测试"""
     try:
-        await bot.send_message(
-            chat_id=CHAT_ID,
-            text="🧪 <b>测试消息</b>\n\n服务运行正常！",
-            parse_mode="HTML"
-        )
+        await enqueue_send("🧪 <b>测试消息</b>\n\n服务运行正常！")
         return {"status": "ok", "message": "Test notification sent"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-# ========== TradingView Webhook ==========
-import json
-
-
 # ========== 命令系统端点 ==========
 
 async def handle_tg_command(update: Update, context):
@@ -280,76 +492,117 @@ async def handle_tg_command(update: Update, context):
     global command_id_counter
     
     text = update.message.text
-    parts = text.split()
-    
-    if len(parts) < 1:
+    if not text or not text.startswith("/"):
         return
     
+    # 最多切三段: /target、action、其余参数；参数部分只有存在时才继续拆分
+    parts = text.split(None, 2)
     target = parts[0][1:]  # 去掉 /
     action = parts[1] if len(parts) > 1 else ""
-    args = parts[2:] if len(parts) > 2 else []
+    args = parts[2].split() if len(parts) > 2 else []
     
     if not target or not action:
         await update.message.reply_text("❌ 格式: /target action [args...]")
         return
     
     # 存储命令
-    with commands_lock:
-        command_id_counter += 1
-        cmd = {
-            "id": command_id_counter,
-            "target": target,
-            "action": action,
-            "args": args,
-            "ts": int(time.time())
-        }
-        commands_store[target].append(cmd)
-        logger.info(f"📥 收到命令: {target} {action} {args}")
+    command_id_counter += 1
+    cmd = {
+        "id": command_id_counter,
+        "target": target,
+        "action": action,
+        "args": args,
+        "ts": int(time.time())
+    }
+    ids, cmds = commands_store[target]
+    ids.append(cmd["id"])
+    cmds.append(cmd)
+    logger.info(f"📥 收到命令: {target} {action} {args}")
+    
+    # 唤醒等待中的长轮询（与 /commands 同在 FastAPI 事件循环上）
+    async with _cmd_cv:
+        _cmd_cv.notify_all()
     
     # 回复确认
     args_str = ' '.join(args) if args else ''
     await update.message.reply_text(f"✓ 命令已发送: {target} {action} {args_str}")
 
 
+def collect_commands(target: str, after: int) -> list[dict]:
+    """返回 target 及 target=all 中 id 大于 after 的命令，按 id 排序"""
+    slices = []
+    
+    # 返回匹配 target 的命令 + target=all 的命令
+    for t in ([target] if target == "all" else [target, "all"]):
+        entry = commands_store.get(t)
+        if entry:
+            ids, cmds = entry
+            slices.append(cmds[bisect.bisect_right(ids, after):])
+    
+    # 各切片已按 id 有序，归并即可
+    return [
+        {
+            "id": cmd["id"],
+            "action": cmd["action"],
+            "args": cmd["args"],
+            "ts": cmd["ts"]
+        }
+        for cmd in heapq.merge(*slices, key=itemgetter("id"))
+    ]
+
+
 @app.get("/commands")
 async def get_commands(
     target: str = Query(..., description="脚本标识"),
-    after: int = Query(0, description="只返回 id 大于此值的命令")
+    after: int = Query(0, description="只返回 id 大于此值的命令"),
+    wait: float = Query(0, ge=0, description="长轮询: 没有新命令时最多等待的秒数（超过 MAX_COMMAND_WAIT 按上限处理）")
 ):
-    """拉取命令（脚本轮询调用）"""
-    result = []
+    """拉取命令（脚本轮询调用），wait > 0 时没有新命令会挂起等待"""
+    # 超出上限就截断而不是返回 422，客户端的 long_poll_timeout 设大了也能正常收命令
+    wait = min(wait, MAX_COMMAND_WAIT)
+    result = collect_commands(target, after)
     
-    with commands_lock:
-        # 返回匹配 target 的命令 + target=all 的命令
-        for t in [target, "all"]:
-            for cmd in commands_store.get(t, []):
-                if cmd["id"] > after:
-                    result.append({
-                        "id": cmd["id"],
-                        "action": cmd["action"],
-                        "args": cmd["args"],
-                        "ts": cmd["ts"]
-                    })
-    
-    # 按 id 排序
-    result.sort(key=lambda x: x["id"])
+    if not result and wait > 0:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        async with _cmd_cv:
+            while not result:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(_cmd_cv.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+                result = collect_commands(target, after)
     
     return {"commands": result}
 
 
-def cleanup_old_commands():
+async def cleanup_old_commands():
     """定期清理超过 1 小时的旧命令"""
     while True:
-        time.sleep(300)  # 每 5 分钟清理一次
+        await asyncio.sleep(300)  # 每 5 分钟清理一次
         cutoff = int(time.time()) - 3600  # 1 小时前
-        with commands_lock:
-            for target in list(commands_store.keys()):
-                commands_store[target] = [c for c in commands_store[target] if c["ts"] > cutoff]
-                if not commands_store[target]:
-                    del commands_store[target]
+        for target, (ids, cmds) in list(commands_store.items()):
+            # 命令按时间顺序追加，过期的只会在最左边，只需数出过期个数再原地删除
+            expired = 0
+            while expired < len(cmds) and cmds[expired]["ts"] <= cutoff:
+                expired += 1
+            if expired == len(cmds):
+                del commands_store[target]
+            elif expired:
+                del ids[:expired]
+                del cmds[:expired]
         logger.debug("🧹 命令清理完成")
 
 
+@app.on_event("startup")
+async def _start_command_cleanup():
+    """启动命令清理任务（与命令读写同在事件循环上）"""
+    app.state.command_cleanup = asyncio.create_task(cleanup_old_commands())
+
+
 
 @app.post("/webhook/{secret}")
 async def tradingview_webhook(secret: str, request: Request):
@@ -361,43 +614,37 @@ async def tradingview_webhook(secret: str, request: Request):
         raise HTTPException(status_code=403, detail="Invalid webhook secret")
     
     # 读取原始 body
-    body = await request.body()
-    body_str = body.decode('utf-8').strip()
+    body = (await request.body()).strip()
     
-    # 尝试解析 JSON，失败则当纯文本
     title = "TradingView Alert"
-    message = body_str
     channel = "trade"
     priority = "normal"
     
-    try:
-        data = json.loads(body_str)
-        if isinstance(data, dict):
-            title = data.get("title", title)
-            message = data.get("message", body_str)
-            channel = data.get("channel", channel)
-            priority = data.get("priority", priority)
-    except json.JSONDecodeError:
+    # 只有看起来像 JSON 对象时才尝试解析；纯文本告警不走异常路径
+    # orjson 直接解析 bytes，JSON 路径无需先整体解码
+    data = None
+    if body[:1] == b"{":
+        try:
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            data = None
+    
+    if isinstance(data, dict):
+        title = str(data.get("title", title))
+        message = str(data["message"]) if "message" in data else body.decode("utf-8")
+        channel = str(data.get("channel", channel))
+        priority = data.get("priority", priority)
+    else:
         # 不是 JSON，直接用原始文本作为 message
-        pass
+        message = body.decode("utf-8")
     
     # 格式化消息
     emoji = CHANNEL_EMOJI.get(channel, "📈")
-    timestamp = datetime.now().strftime("%H:%M:%S")
     priority_mark = "🔴 " if priority == "high" else ""
-    
-    text = f"""{priority_mark}{emoji} <b>{title}</b>
-
-{message}
-
-<code>[{channel}] {timestamp}</code>"""
+    text = build_message(priority_mark, emoji, title, message, channel)
     
     try:
-        await bot.send_message(
-            chat_id=CHAT_ID,
-            text=text,
-            parse_mode="HTML"
-        )
+        await enqueue_send(text, key=(channel, title))
         logger.info(f"📈 TradingView webhook: {title}")
         return {"status": "ok"}
     except Exception as e:
@@ -406,27 +653,30 @@ async def tradingview_webhook(secret: str, request: Request):
 
 
 # Telegram Bot 轮询处理（用于接收按钮回调 + 命令）
-def run_telegram_polling():
-    """在单独线程运行 Telegram 轮询"""
-    async def start_polling():
-        application = Application.builder().token(BOT_TOKEN).build()
-        
-        # 命令处理（必须在 CallbackQueryHandler 之前）
-        application.add_handler(MessageHandler(filters.COMMAND, handle_tg_command))
-        application.add_handler(CallbackQueryHandler(handle_callback))
-        
-        logger.info("🤖 Telegram Bot 轮询启动...")
-        await application.initialize()
-        await application.start()
-        await application.updater.start_polling(drop_pending_updates=True)
-        
-        # 保持运行
-        while True:
-            await asyncio.sleep(1)
-    
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(start_polling())
+# 与 FastAPI 运行在同一个事件循环上，pending_alerts / commands_store 不会被两个循环并发修改
+# 复用上面的 bot，回调和命令回复也走同一个连接池
+application = Application.builder().bot(bot).build()
+
+# 命令处理（必须在 CallbackQueryHandler 之前）
+application.add_handler(MessageHandler(filters.COMMAND, handle_tg_command))
+application.add_handler(CallbackQueryHandler(handle_callback))
+
+
+@app.on_event("startup")
+async def _start_telegram_polling():
+    """在 FastAPI 事件循环上启动 Telegram 轮询"""
+    logger.info("🤖 Telegram Bot 轮询启动...")
+    await application.initialize()
+    await application.start()
+    await application.updater.start_polling(drop_pending_updates=True)
+
+
+@app.on_event("shutdown")
+async def _stop_telegram_polling():
+    """停止 Telegram 轮询"""
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
 
 
 if __name__ == "__main__":
@@ -441,7 +691,7 @@ if __name__ == "__main__":
     print(f"  Bot Token: {BOT_TOKEN[:20]}...")
     print(f"  Chat ID: {CHAT_ID}")
     print(f"  端口: {PORT}")
-    print(f"  Twilio: {'✓ 已配置' if twilio_client else '✗ 未配置'}")
+    print(f"  Twilio: {'✓ 已配置' if TWILIO_CONFIGURED else '✗ 未配置'}")
     print(f"  电话延迟: {CALL_DELAY_SECONDS} 秒")
     print("-" * 60)
     print(f"  📡 TradingView Webhook:")
@@ -450,13 +700,7 @@ if __name__ == "__main__":
     print(f"     GET /commands?target=<target>&after=0")
     print("=" * 60)
     
-    # 启动命令清理线程
-    cleanup_thread = threading.Thread(target=cleanup_old_commands, daemon=True)
-    cleanup_thread.start()
-    
-    # 启动 Telegram 轮询线程（用于接收按钮回调 + 命令）
-    telegram_thread = threading.Thread(target=run_telegram_polling, daemon=True)
-    telegram_thread.start()
-    
     # 启动 FastAPI
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
\ No newline at end of file
+    # 安装 uvicorn[standard] 后默认（loop/http="auto"）即使用 uvloop + httptools
+    # 必须单进程运行: pending_alerts / commands_store 都在内存中，多 worker 会各自持有一份
+    uvicorn.run(app, host="0.0.0.0", port=PORT, workers=1)
\ No newline at end of file